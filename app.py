@@ -1,12 +1,21 @@
 import os
+import atexit
 import logging
 import time
-from datetime import datetime, timedelta
+import queue
+import re
+import shutil
+import tempfile
+import threading
 from functools import wraps
-from flask import Flask, request, jsonify, send_from_directory
+from itertools import groupby
+from cachetools import Cache, TTLCache
+import orjson
+from flask import Flask, Response, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, Histogram, generate_latest
 from pathlib import Path
 
-from whatsapp_bot import WhatsAppBot
+from whatsapp_bot import WhatsAppBot, create_driver, load_session_meta
 
 # Configure basic logging with timestamps
 logging.basicConfig(
@@ -19,15 +28,227 @@ logger = logging.getLogger("whatsapp_sender.app")
 HEADLESS = os.getenv("HEADLESS", "true").lower() == "true"
 API_KEY = os.getenv("API_KEY")  # Optional simple API key protection
 SESSION_TIMEOUT_MINUTES = int(os.getenv("SESSION_TIMEOUT_MINUTES", "30"))
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "10"))  # Each live session holds a Chrome process
+SESSION_META_MAX_AGE_HOURS = int(os.getenv("SESSION_META_MAX_AGE_HOURS", "24"))  # Trust a saved login this long
+POOL_MIN = int(os.getenv("POOL_MIN", "0"))  # Pre-warmed Chrome instances kept ready for new devices
+CLOSE_WAIT_SECONDS = 30  # How long a request waits for the device's previous bot to finish closing
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "100"))  # Messages per batch request; the device lock is held for all of them
+
+# Device IDs become directory names under SESSIONS_DIR, so keep them to a safe alphabet
+DEVICE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
 
 # Directory to store session data
 SESSIONS_DIR = Path("./sessions")
 SESSIONS_DIR.mkdir(exist_ok=True)
 
-# Dictionary to store active bot instances
-bot_instances = {}
+class DriverPool:
+    """Keeps Chrome instances launched ahead of time so new devices skip the cold start.
+
+    Pooled drivers start on fresh profiles under ``profiles_dir``. A device that
+    logs in on one adopts that profile for good; drivers that never logged in
+    are wiped and reused.
+    """
+
+    def __init__(self, min_size, profiles_dir, headless=True):
+        self.min_size = min_size
+        self.profiles_dir = Path(profiles_dir)
+        self.headless = headless
+        self._idle = queue.Queue()
+        self._profiles = {}  # driver session id -> user data dir still owned by the pool
+        self._refill_needed = threading.Event()
+        self._closed = False
+        if min_size > 0:
+            self.profiles_dir.mkdir(parents=True, exist_ok=True)
+            threading.Thread(target=self._refill_loop, name="driver-pool", daemon=True).start()
+            self._refill_needed.set()
+
+    def _refill_loop(self):
+        while not self._closed:
+            self._refill_needed.wait()
+            self._refill_needed.clear()
+            while not self._closed and self._idle.qsize() < self.min_size:
+                user_data_dir = tempfile.mkdtemp(prefix="profile-", dir=self.profiles_dir)
+                try:
+                    driver = create_driver(user_data_dir, headless=self.headless)
+                except Exception as e:
+                    logger.error(f"Failed to pre-warm Chrome instance: {e}")
+                    shutil.rmtree(user_data_dir, ignore_errors=True)
+                    break
+                self._profiles[driver.session_id] = user_data_dir
+                self._idle.put(driver)
+                logger.info(f"Pre-warmed Chrome instance ready ({self._idle.qsize()}/{self.min_size})")
+
+    def acquire(self):
+        """Return an idle driver, or None if the pool is disabled or drained"""
+        if self.min_size <= 0:
+            return None
+        try:
+            driver = self._idle.get_nowait()
+        except queue.Empty:
+            driver = None
+        self._refill_needed.set()
+        return driver
+
+    def adopt(self, driver):
+        """Hand a driver and its profile over to a device for good; returns the profile path"""
+        return self._profiles.pop(driver.session_id)
+
+    def release(self, driver):
+        """Wipe a driver that never logged in and put it back, or discard it if the pool is full"""
+        if self._closed:
+            self._discard(driver)
+            return
+        try:
+            driver.delete_all_cookies()
+            driver.execute_cdp_cmd("Storage.clearDataForOrigin", {
+                "origin": "https://web.whatsapp.com",
+                "storageTypes": "all",
+            })
+            driver.get("about:blank")
+        except Exception as e:
+            logger.warning(f"Discarding pooled Chrome instance that failed to reset: {e}")
+            self._discard(driver)
+            return
+        if self._idle.qsize() >= self.min_size:
+            self._discard(driver)
+        else:
+            self._idle.put(driver)
+
+    def _discard(self, driver):
+        user_data_dir = self._profiles.pop(driver.session_id, None)
+        try:
+            driver.quit()
+        except Exception as e:
+            logger.error(f"Error quitting pooled Chrome instance: {e}")
+        if user_data_dir:
+            shutil.rmtree(user_data_dir, ignore_errors=True)
+
+    def shutdown(self):
+        """Quit idle drivers and remove their profiles"""
+        self._closed = True
+        self._refill_needed.set()
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(driver)
+
+class BotCache(TTLCache):
+    """LRU cache of bots with an idle TTL.
+
+    Bots that leave the cache are queued rather than closed on the spot, since
+    quitting Chrome takes seconds and may have to wait for a request still
+    using the bot; callers hand ``pop_evicted()`` to ``close_bots()``.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._evicted = []
+
+    def __delitem__(self, device_id):
+        bot = Cache.__getitem__(self, device_id)
+        try:
+            super().__delitem__(device_id)
+        finally:
+            self._evicted.append((device_id, bot))
+
+    def expire(self, time=None):
+        # TTLCache drops expired entries without going through __delitem__
+        expired = super().expire(time)
+        for device_id, _ in expired:
+            logger.info(f"Session for device {device_id} idle for {SESSION_TIMEOUT_MINUTES} minutes, closing")
+        self._evicted.extend(expired)
+        return expired
+
+    def pop_evicted(self):
+        evicted, self._evicted = self._evicted, []
+        return evicted
+
+# device_id -> thread closing a bot that left bot_instances; guarded by bot_instances_lock
+_pending_closes = {}
+
+def close_bots(evicted):
+    """Close bots removed from bot_instances in the background; call with bot_instances_lock held.
+
+    Each close waits for the bot's lock, so a request still driving the browser
+    finishes before it is quit. A pending QR-scan wait is cut short via
+    ``bot.closing``.
+    """
+    for device_id, bot in evicted:
+        bot.closing.set()
+        worker = threading.Thread(target=_close_when_idle, args=(device_id, bot), name=f"close-{device_id}", daemon=True)
+        _pending_closes[device_id] = worker
+        worker.start()
+
+def _close_when_idle(device_id, bot):
+    with bot.lock:
+        logger.info(f"Closing session for device: {device_id}")
+        bot.close()
+    with bot_instances_lock:
+        if _pending_closes.get(device_id) is threading.current_thread():
+            del _pending_closes[device_id]
+
+# Active bot instances, keyed by device ID
+bot_instances = BotCache(maxsize=MAX_SESSIONS, ttl=SESSION_TIMEOUT_MINUTES * 60)
+bot_instances_lock = threading.RLock()
+def remove_orphaned_profiles(pool_dir):
+    """Delete pool profiles left behind by a killed process; a profile is kept only while a device's meta.json points at it"""
+    in_use = set()
+    for meta_path in SESSIONS_DIR.glob("*/meta.json"):
+        user_data_dir = load_session_meta(meta_path).get("user_data_dir")
+        if user_data_dir:
+            in_use.add(Path(user_data_dir).resolve())
+    for profile in pool_dir.glob("profile-*"):
+        if profile.is_dir() and profile.resolve() not in in_use:
+            logger.info(f"Removing orphaned Chrome profile: {profile}")
+            shutil.rmtree(profile, ignore_errors=True)
+
+remove_orphaned_profiles(SESSIONS_DIR / ".pool")
+driver_pool = DriverPool(POOL_MIN, SESSIONS_DIR / ".pool", headless=HEADLESS)
+atexit.register(driver_pool.shutdown)
 app = Flask(__name__)
 
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time spent serving each API endpoint",
+    ["endpoint", "method", "status"],
+)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_timing(response):
+    start = g.pop("request_start", None)
+    if start is not None:
+        REQUEST_SECONDS.labels(
+            request.endpoint or "unmatched", request.method, str(response.status_code)
+        ).observe(time.perf_counter() - start)
+    return response
+
+@app.before_request
+def validate_device_id():
+    """Reject device IDs that could escape or collide inside SESSIONS_DIR (e.g. '..' or '.pool')"""
+    device_id = (request.view_args or {}).get("device_id")
+    if device_id is not None and not DEVICE_ID_PATTERN.match(device_id):
+        return ojsonify({"success": False, "error": "Invalid device ID: use letters, digits, '-' or '_'"}, 400)
+
+_ts_cache = (0, "")
+
+def iso_now():
+    """Current UTC time as an ISO-8601 string, reformatted at most once per second"""
+    global _ts_cache
+    now = int(time.time())
+    if now != _ts_cache[0]:
+        _ts_cache = (now, time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now)))
+    return _ts_cache[1]
+
+def ojsonify(obj, status=200):
+    """jsonify() replacement that serializes with orjson"""
+    return app.response_class(orjson.dumps(obj), status=status, mimetype="application/json")
+
 def require_api_key(f):
     """Decorator for API key authentication"""
     @wraps(f)
@@ -35,35 +256,68 @@ def require_api_key(f):
         if API_KEY:
             provided_key = request.headers.get("X-API-KEY")
             if not provided_key or provided_key != API_KEY:
-                return jsonify({"success": False, "error": "Invalid or missing API key"}), 401
+                return ojsonify({"success": False, "error": "Invalid or missing API key"}, 401)
         return f(*args, **kwargs)
     return wrapper
 
+class SessionBusy(Exception):
+    """The device's previous bot did not finish closing within CLOSE_WAIT_SECONDS"""
+
 def get_or_create_bot(device_id='default', force_new=False):
-    """Get or create a bot instance for the given device ID"""
-    if not force_new and device_id in bot_instances:
-        return bot_instances[device_id]
-        
+    """Get or create a bot instance for the given device ID; raises SessionBusy if its predecessor is still closing"""
+    with bot_instances_lock:
+        bot = _get_or_create_bot_locked(device_id, force_new)
+        close_bots(bot_instances.pop_evicted())
+        pending_close = _pending_closes.get(device_id)
+    if pending_close:
+        # The previous bot for this device is still shutting down; let it release the profile first
+        pending_close.join(CLOSE_WAIT_SECONDS)
+        if pending_close.is_alive():
+            raise SessionBusy(f"Previous session for device {device_id} is still closing, retry shortly")
+    return bot
+
+def _get_or_create_bot_locked(device_id, force_new):
+    """Body of get_or_create_bot; the caller holds bot_instances_lock"""
+    if device_id in bot_instances:
+        if not force_new:
+            bot = bot_instances[device_id]
+            bot_instances[device_id] = bot  # Re-insert to restart the idle timeout
+            return bot
+        del bot_instances[device_id]
+    
     # Create new bot instance with device-specific profile
     profile_dir = SESSIONS_DIR / device_id
-    bot = WhatsAppBot(headless=HEADLESS, profile_dir=profile_dir)
+    bot = WhatsAppBot(device_id=device_id, headless=HEADLESS, profile_dir=profile_dir)
+    has_saved_profile = os.path.isdir(bot.user_data_dir)
+    
+    # A recent login on disk means the profile is still signed in: skip loading
+    # WhatsApp Web now and let the first send start the browser
+    if has_saved_profile and bot.recently_authenticated(SESSION_META_MAX_AGE_HOURS * 3600):
+        logger.info(f"Restoring authenticated session for device: {device_id}")
+        bot.is_authenticated = True
+    
+    # A device with no profile yet can start on a pre-warmed driver; it keeps
+    # that driver's profile once it logs in
+    if not has_saved_profile:
+        driver = driver_pool.acquire()
+        if driver:
+            bot.bind(driver, pool=driver_pool)
+    
     bot_instances[device_id] = bot
     return bot
 
-def cleanup_old_sessions():
-    """Clean up old and inactive sessions"""
-    current_time = time.time()
-    timeout_seconds = SESSION_TIMEOUT_MINUTES * 60
-    
-    for device_id, bot in list(bot_instances.items()):
+def _expire_sessions_loop():
+    """Close idle sessions once a minute instead of waiting for the next cache write"""
+    while True:
+        time.sleep(60)
         try:
-            # Check if session is too old
-            if current_time - bot.last_activity > timeout_seconds:
-                logger.info(f"Cleaning up old session for device: {device_id}")
-                bot.close()
-                del bot_instances[device_id]
+            with bot_instances_lock:
+                bot_instances.expire()
+                close_bots(bot_instances.pop_evicted())
         except Exception as e:
-            logger.error(f"Error cleaning up session for {device_id}: {e}")
+            logger.error(f"Error expiring idle sessions: {e}")
+
+threading.Thread(target=_expire_sessions_loop, name="session-expiry", daemon=True).start()
 
 @app.route("/initialize/<device_id>", methods=["POST"])
 @require_api_key
@@ -75,59 +329,72 @@ def initialize_session(device_id='default'):
         # Check existing session first
         bot = get_or_create_bot(device_id)
         
-        # Check if already authenticated
-        if bot.is_authenticated:
-            logger.info(f"Device {device_id} already authenticated, reusing session")
-            return jsonify({
-                'success': True,
-                'message': 'Session already authenticated',
-                'device_id': device_id,
-                'qr_required': False,
-                'timestamp': datetime.now().isoformat()
-            })
+        # One Selenium driver per device: serialize work on it, other devices run in parallel
+        with bot.lock:
+            # Check if already authenticated
+            if bot.is_authenticated:
+                logger.info(f"Device {device_id} already authenticated, reusing session")
+                return ojsonify({
+                    'success': True,
+                    'message': 'Session already authenticated',
+                    'device_id': device_id,
+                    'qr_required': False,
+                    'timestamp': iso_now()
+                })
         
-        # Initialize new session
-        result = bot.initialize_session()
+            # Initialize new session
+            result = bot.initialize_session()
         
-        if result.get('success'):
-            return jsonify({
-                'success': True,
-                'message': 'Session initialized successfully',
-                'device_id': device_id,
-                'qr_required': result.get('qr_required', False),
-                'qr_url': f'/qr/{device_id}' if result.get('qr_required') else None,
-                'timestamp': datetime.now().isoformat()
-            })
-        else:
-            return jsonify({
-                'success': False,
-                'error': result.get('error', 'Unknown error initializing session'),
-                'device_id': device_id,
-                'timestamp': datetime.now().isoformat()
-            }), 500
+            if result.get('success'):
+                return ojsonify({
+                    'success': True,
+                    'message': 'Session initialized successfully',
+                    'device_id': device_id,
+                    'qr_required': result.get('qr_required', False),
+                    'qr_url': f'/qr/{device_id}' if result.get('qr_required') else None,
+                    'timestamp': iso_now()
+                })
+            else:
+                return ojsonify({
+                    'success': False,
+                    'error': result.get('error', 'Unknown error initializing session'),
+                    'device_id': device_id,
+                    'timestamp': iso_now()
+                }, 500)
             
+    except SessionBusy as e:
+        return ojsonify({
+            'success': False,
+            'error': str(e),
+            'device_id': device_id,
+            'timestamp': iso_now()
+        }, 503)
     except Exception as e:
         logger.error(f"Error initializing session: {str(e)}", exc_info=True)
-        return jsonify({
+        return ojsonify({
             'success': False,
             'error': f'Error initializing session: {str(e)}',
             'device_id': device_id,
-            'timestamp': datetime.now().isoformat()
-        }), 500
+            'timestamp': iso_now()
+        }, 500)
 
 @app.route("/qr/<device_id>")
 @require_api_key
 def get_qr_code(device_id):
     """Get the QR code for a device session"""
     try:
-        bot = get_or_create_bot(device_id)
-        qr_path = bot.get_qr_code_path()
-        if qr_path and qr_path.exists():
-            return send_from_directory(qr_path.parent, qr_path.name)
-        return jsonify({"success": False, "error": "QR code not available"}), 404
+        # Read-only: never create a bot (and possibly evict a live one) just to poll for a QR code
+        with bot_instances_lock:
+            bot = bot_instances.get(device_id)
+        if bot is None:
+            return ojsonify({"success": False, "error": f"No active session for device {device_id}"}, 404)
+        qr_png = bot.qr_png_bytes
+        if qr_png:
+            return Response(qr_png, mimetype="image/png")
+        return ojsonify({"success": False, "error": "QR code not available"}, 404)
     except Exception as e:
         logger.error(f"Error getting QR code: {str(e)}")
-        return jsonify({"success": False, "error": str(e)}), 500
+        return ojsonify({"success": False, "error": str(e)}, 500)
 
 @app.route("/send/<device_id>", methods=["POST"])
 @require_api_key
@@ -137,61 +404,128 @@ def send_message(device_id='default'):
     phone = data.get("phone")
     message = data.get("message")
 
-    if not phone or not message:
-        return jsonify({"success": False, "error": "'phone' and 'message' fields are required"}), 400
+    if not isinstance(phone, str) or not phone or not isinstance(message, str) or not message.strip():
+        return ojsonify({"success": False, "error": "A string 'phone' and a non-blank string 'message' are required"}, 400)
 
     try:
         bot = get_or_create_bot(device_id)
-        success = bot.send_message(phone, message)
+        with bot.lock:
+            result = bot.send_message(phone, message)
         
-        if success:
-            return jsonify({
+        if result.get("success"):
+            return ojsonify({
                 "success": True,
                 "device_id": device_id,
                 "phone": phone,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": iso_now()
             })
-        return jsonify({
+        return ojsonify({
             "success": False,
-            "error": "Failed to send message",
+            "error": result.get("error", "Failed to send message"),
             "device_id": device_id,
-            "timestamp": datetime.now().isoformat()
-        }), 500
+            "timestamp": iso_now()
+        }, 500)
         
+    except SessionBusy as e:
+        return ojsonify({
+            "success": False,
+            "error": str(e),
+            "device_id": device_id,
+            "timestamp": iso_now()
+        }, 503)
     except Exception as e:
         logger.error(f"Error sending message: {str(e)}", exc_info=True)
-        return jsonify({
+        return ojsonify({
             "success": False,
             "error": str(e),
             "device_id": device_id,
-            "timestamp": datetime.now().isoformat()
-        }), 500
+            "timestamp": iso_now()
+        }, 500)
+
+@app.route("/send/<device_id>/batch", methods=["POST"])
+@require_api_key
+def send_batch(device_id):
+    """Send many messages in one request, staying on the chat for consecutive messages to the same phone"""
+    data = request.get_json(silent=True) or {}
+    messages = data.get("messages")
+
+    if not isinstance(messages, list) or not messages:
+        return ojsonify({"success": False, "error": "'messages' must be a non-empty list"}, 400)
+    if len(messages) > MAX_BATCH_SIZE:
+        return ojsonify({"success": False, "error": f"'messages' may hold at most {MAX_BATCH_SIZE} entries"}, 400)
+    for item in messages:
+        if (not isinstance(item, dict)
+                or not isinstance(item.get("phone"), str) or not item["phone"]
+                or not isinstance(item.get("message"), str) or not item["message"].strip()):
+            return ojsonify({"success": False, "error": "Each entry in 'messages' requires a string 'phone' and a non-blank string 'message'"}, 400)
+
+    try:
+        bot = get_or_create_bot(device_id)
+        results = []
+        with bot.lock:
+            for phone, group in groupby(messages, key=lambda item: item["phone"]):
+                texts = [item["message"] for item in group]
+                for result in bot.send_messages(phone, texts):
+                    results.append({"phone": phone, **result})
+        
+        sent = sum(1 for result in results if result["success"])
+        return ojsonify({
+            "success": sent == len(results),
+            "device_id": device_id,
+            "sent": sent,
+            "failed": len(results) - sent,
+            "results": results,
+            "timestamp": iso_now()
+        })
+        
+    except SessionBusy as e:
+        return ojsonify({
+            "success": False,
+            "error": str(e),
+            "device_id": device_id,
+            "timestamp": iso_now()
+        }, 503)
+    except Exception as e:
+        logger.error(f"Error sending message batch: {str(e)}", exc_info=True)
+        return ojsonify({
+            "success": False,
+            "error": str(e),
+            "device_id": device_id,
+            "timestamp": iso_now()
+        }, 500)
 
 @app.route("/sessions/<device_id>", methods=["DELETE"])
 @require_api_key
 def delete_session(device_id):
     """Delete a device session"""
     try:
-        if device_id in bot_instances:
-            bot_instances[device_id].close()
-            del bot_instances[device_id]
+        with bot_instances_lock:
+            if device_id in bot_instances:
+                del bot_instances[device_id]
+            close_bots(bot_instances.pop_evicted())
         # Optionally: Delete the session directory
         # import shutil
         # session_dir = SESSIONS_DIR / device_id
         # if session_dir.exists():
         #     shutil.rmtree(session_dir)
-        return jsonify({"success": True, "message": f"Session {device_id} deleted"})
+        return ojsonify({"success": True, "message": f"Session {device_id} deleted"})
     except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 500
+        return ojsonify({"success": False, "error": str(e)}, 500)
 
 @app.route("/healthz", methods=["GET"])
 def health_check():
     """Health check endpoint"""
-    return jsonify({
+    return ojsonify({
         "status": "ok",
-        "timestamp": datetime.now().isoformat(),
+        "timestamp": iso_now(),
         "active_sessions": len(bot_instances)
     })
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus metrics: per-endpoint latency and per-step WhatsAppBot timings"""
+    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000)
+    # Local development only; the container runs under gunicorn (see Dockerfile)
+    app.run(host="0.0.0.0", port=5000, threaded=True)
@@ -5,168 +5,253 @@ import json
 import base64
 import uuid
 import tempfile
+import functools
+import threading
+import weakref
 from datetime import datetime
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
-from selenium.common.exceptions import TimeoutException, NoSuchElementException, WebDriverException
+from selenium.common.exceptions import TimeoutException, WebDriverException, StaleElementReferenceException
 from selenium.webdriver.common.action_chains import ActionChains
+from selenium.webdriver.remote.remote_connection import RemoteConnection
 import pickle
 import shutil
+from prometheus_client import Histogram
 
 logger = logging.getLogger(__name__)
 
+# urllib3 connections kept per driver; Selenium's default of 1 serializes concurrent commands
+DRIVER_HTTP_POOL_SIZE = int(os.getenv("DRIVER_HTTP_POOL_SIZE", "20"))
+
+STEP_SECONDS = Histogram("whatsapp_step_seconds", "Time spent in each WhatsAppBot step", ["step"])
+
+def timed(step):
+    """Decorator recording the wrapped call's duration in STEP_SECONDS under the given step label"""
+    return STEP_SECONDS.labels(step).time()
+
+# Seconds a finalizer waits for an orphaned driver to shut down
+FINALIZER_TIMEOUT = 5
+
+# Static assets WhatsApp Web renders fine without; skipping them speeds up every chat navigation.
+# The QR code is drawn on a canvas, so it is unaffected.
+BLOCKED_URL_PATTERNS = ("*.jpg", "*.jpeg", "*.png", "*.webp", "*.mp4", "*.ogg", "*.woff*")
+
+# Deletes every non-digit Latin-1 character, so phone cleanup runs in C
+_NONDIGIT = str.maketrans('', '', ''.join(chr(c) for c in range(256) if not chr(c).isdigit()))
+
+_base_get_connection_manager = RemoteConnection._get_connection_manager
+
+def _get_connection_manager(self):
+    manager = _base_get_connection_manager(self)
+    manager.connection_pool_kw.update(maxsize=DRIVER_HTTP_POOL_SIZE, block=False)
+    return manager
+
+RemoteConnection._get_connection_manager = _get_connection_manager
+
+# Install locations don't change while the process runs, so look them up once
+@functools.lru_cache(maxsize=1)
+def _find_chrome_executable():
+    possible_paths = [
+        '/usr/bin/google-chrome',
+        '/usr/bin/google-chrome-stable',
+        '/usr/bin/chromium-browser',
+        '/usr/bin/chromium',
+        '/opt/google/chrome/chrome'
+    ]
+    for path in possible_paths:
+        if os.path.exists(path):
+            logger.info(f"Found Chrome at: {path}")
+            return path
+    chrome_path = shutil.which('google-chrome') or shutil.which('google-chrome-stable') or shutil.which('chromium')
+    if chrome_path:
+        logger.info(f"Found Chrome using which: {chrome_path}")
+        return chrome_path
+    logger.error("Chrome executable not found")
+    return None
+
+@functools.lru_cache(maxsize=1)
+def _find_chromedriver_executable():
+    possible_paths = [
+        '/usr/local/bin/chromedriver',
+        '/usr/bin/chromedriver',
+        '/opt/chromedriver',
+        '/app/chromedriver'
+    ]
+    for path in possible_paths:
+        if os.path.exists(path):
+            logger.info(f"Found ChromeDriver at: {path}")
+            return path
+    chromedriver_path = shutil.which('chromedriver')
+    if chromedriver_path:
+        logger.info(f"Found ChromeDriver using which: {chromedriver_path}")
+        return chromedriver_path
+    logger.error("ChromeDriver executable not found")
+    return None
+
+# Flags shared by every Chrome launch; only the profile, debug port and headless flags vary
+BASE_CHROME_ARGS = (
+    "--no-sandbox",
+    "--disable-dev-shm-usage",
+    "--disable-gpu",
+    "--disable-extensions",
+    "--disable-plugins",
+    "--disable-background-timer-throttling",
+    "--disable-backgrounding-occluded-windows",
+    "--disable-renderer-backgrounding",
+    "--disable-features=TranslateUI",
+    "--disable-ipc-flooding-protection",
+    "--disable-background-networking",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--disable-translate",
+    "--hide-scrollbars",
+    "--metrics-recording-only",
+    "--mute-audio",
+    "--no-first-run",
+    "--safebrowsing-disable-auto-update",
+    "--ignore-certificate-errors",
+    "--ignore-ssl-errors",
+    "--ignore-certificate-errors-spki-list",
+    "--disable-features=VizDisplayCompositor",
+    "--disable-web-security",
+    "--disable-blink-features=AutomationControlled",
+    "--disable-infobars",
+    "--disable-notifications",
+    "--disable-popup-blocking",
+    "--disable-session-crashed-bubble",
+    "--disable-password-generation",
+    "--disable-password-manager-reauthentication",
+    "--user-agent=Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "--profile-directory=Default",
+    "--window-size=1920,1080",
+    "--start-maximized",
+)
+
+BASE_PREFS = {
+    "profile.default_content_setting_values.notifications": 2,
+    "profile.default_content_settings.popups": 0,
+    "profile.managed_default_content_settings.images": 2,
+    "profile.content_settings.exceptions.automatic_downloads.*.setting": 1,
+    "profile.default_content_setting_values.media_stream_mic": 2,
+    "profile.default_content_setting_values.media_stream_camera": 2,
+    "profile.default_content_setting_values.geolocation": 2,
+    "profile.default_content_setting_values.desktop_notification": 2
+}
+
+def create_driver(user_data_dir, headless=True, debug_port=None):
+    """Launch a Chrome WebDriver using the given profile directory"""
+    chrome_path = _find_chrome_executable()
+    chromedriver_path = _find_chromedriver_executable()
+    
+    if not chrome_path:
+        raise RuntimeError("Chrome executable not found")
+    if not chromedriver_path:
+        raise RuntimeError("ChromeDriver executable not found")
+    
+    chrome_options = Options()
+    chrome_options.binary_location = chrome_path
+    chrome_options.page_load_strategy = "eager"  # Return on DOMContentLoaded; waits target the UI we need
+    
+    for argument in BASE_CHROME_ARGS:
+        chrome_options.add_argument(argument)
+    chrome_options.add_argument(f"--user-data-dir={user_data_dir}")
+    if debug_port:
+        chrome_options.add_argument(f"--remote-debugging-port={debug_port}")
+    if headless:
+        chrome_options.add_argument("--headless=new")
+    
+    chrome_options.add_experimental_option("prefs", dict(BASE_PREFS))
+    chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
+    chrome_options.add_experimental_option('useAutomationExtension', False)
+    
+    service = Service(chromedriver_path)
+    driver = webdriver.Chrome(service=service, options=chrome_options)
+    driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
+    driver.set_page_load_timeout(30)
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": list(BLOCKED_URL_PATTERNS)})
+    return driver
+
 class WhatsAppBot:
+    # Any of these means the chat list is showing, i.e. the device is logged in
+    AUTHENTICATED_SELECTOR = (
+        'div[data-testid="chat-list"], '
+        'div[aria-label="Chat list"], '
+        'div[data-testid="side"], '
+        'header[data-testid="chatlist-header"]'
+    )
+    # Selectors for elements we act on are tried in priority order: a CSS union
+    # matches in document order, and the generic fallbacks also hit other parts
+    # of the page (e.g. role="textbox" matches the sidebar search box).
+    # The joined *_SELECTOR forms are only for presence checks.
+    QR_SELECTORS = (
+        'canvas[aria-label="Scan me!"]',
+        'div[data-ref] canvas',
+        'canvas[aria-label*="QR"]'
+    )
+    QR_SELECTOR = ", ".join(QR_SELECTORS)
+    # WhatsApp Web has finished loading once it shows either the chat list or a QR code
+    LANDING_SELECTOR = f"{AUTHENTICATED_SELECTOR}, {QR_SELECTOR}"
+    CHAT_INPUT_SELECTORS = (
+        'div[data-testid="conversation-compose-box-input"]',
+        'div[contenteditable="true"][data-tab="10"]',
+        'div[role="textbox"]'
+    )
+    # role="textbox" also matches the chat-list search box, so it only counts as a
+    # last-resort input, never as proof that the conversation has opened
+    CHAT_INPUT_SELECTOR = ", ".join(CHAT_INPUT_SELECTORS[:-1])
+    ATTACH_SELECTORS = (
+        'div[data-testid="clip"]',
+        'span[data-testid="clip"]',
+        'div[title="Attach"]'
+    )
+    FILE_INPUT_SELECTORS = ('input[accept*="image"]', 'input[type="file"]')
+    SEND_SELECTORS = (
+        'span[data-testid="send"]',
+        'div[data-testid="send"]',
+        'button[data-testid="send"]'
+    )
+    
     def __init__(self, device_id='default', headless=True, profile_dir=None):
         self.device_id = device_id
         self.headless = headless
         self.driver = None
+        self._pool = None
+        self._waits = {}
+        self._finalizer = None
+        self.lock = threading.Lock()  # WebDriver is not thread-safe; hold while driving the browser
+        self.closing = threading.Event()  # Set once the bot is due to close; long waits give up the lock early
         self.session_dir = f"sessions/{device_id}"
-        self.qr_code_path = f"qr_codes/{device_id}_qr.png"
+        self.qr_png_bytes = None  # Latest QR code as PNG, served straight from memory
         self.is_authenticated = False
         self.whatsapp_url = "https://web.whatsapp.com/"
         self.profile_dir = str(profile_dir) if profile_dir else f"{self.session_dir}/user_data"
+        self.meta_path = os.path.join(self.session_dir, "meta.json")
+        self.user_data_dir = self._load_session_meta().get('user_data_dir') or os.path.join(self.session_dir, "user_data")
         
         os.makedirs(self.session_dir, exist_ok=True)
-        os.makedirs("qr_codes", exist_ok=True)
         os.makedirs(self.profile_dir, exist_ok=True)
         
         logger.info(f"WhatsApp bot initialized for device: {device_id}")
         self.last_activity = time.time()
     
-    def __del__(self):
-        try:
-            if hasattr(self, 'driver') and self.driver:
-                self.driver.quit()
-            if hasattr(self, 'device_id'):
-                logger.info(f"WhatsApp bot destroyed for device: {self.device_id}")
-        except Exception as e:
-            logger.error(f"Error destroying WhatsApp bot: {str(e)}")
-    
-    def _find_chrome_executable(self):
-        possible_paths = [
-            '/usr/bin/google-chrome',
-            '/usr/bin/google-chrome-stable',
-            '/usr/bin/chromium-browser',
-            '/usr/bin/chromium',
-            '/opt/google/chrome/chrome'
-        ]
-        for path in possible_paths:
-            if os.path.exists(path):
-                logger.info(f"Found Chrome at: {path}")
-                return path
-        chrome_path = shutil.which('google-chrome') or shutil.which('google-chrome-stable') or shutil.which('chromium')
-        if chrome_path:
-            logger.info(f"Found Chrome using which: {chrome_path}")
-            return chrome_path
-        logger.error("Chrome executable not found")
-        return None
-    
-    def _find_chromedriver_executable(self):
-        possible_paths = [
-            '/usr/local/bin/chromedriver',
-            '/usr/bin/chromedriver',
-            '/opt/chromedriver',
-            '/app/chromedriver'
-        ]
-        for path in possible_paths:
-            if os.path.exists(path):
-                logger.info(f"Found ChromeDriver at: {path}")
-                return path
-        chromedriver_path = shutil.which('chromedriver')
-        if chromedriver_path:
-            logger.info(f"Found ChromeDriver using which: {chromedriver_path}")
-            return chromedriver_path
-        logger.error("ChromeDriver executable not found")
-        return None
-    
     def _setup_driver(self):
         try:
-            chrome_path = self._find_chrome_executable()
-            chromedriver_path = self._find_chromedriver_executable()
-            
-            if not chrome_path:
-                logger.error("Chrome executable not found")
-                return False
-            if not chromedriver_path:
-                logger.error("ChromeDriver executable not found")
-                return False
-            
-            chrome_options = Options()
-            chrome_options.binary_location = chrome_path
-            
-            user_data_dir = os.path.join(self.session_dir, "user_data")
-            os.makedirs(user_data_dir, exist_ok=True)
+            os.makedirs(self.user_data_dir, exist_ok=True)
             os.chmod(self.session_dir, 0o700)  # Secure permissions
             
-            chrome_options.add_argument("--no-sandbox")
-            chrome_options.add_argument("--disable-dev-shm-usage")
-            chrome_options.add_argument("--disable-gpu")
-            chrome_options.add_argument("--disable-extensions")
-            chrome_options.add_argument("--disable-plugins")
-            chrome_options.add_argument("--disable-background-timer-throttling")
-            chrome_options.add_argument("--disable-backgrounding-occluded-windows")
-            chrome_options.add_argument("--disable-renderer-backgrounding")
-            chrome_options.add_argument("--disable-features=TranslateUI")
-            chrome_options.add_argument("--disable-ipc-flooding-protection")
-            chrome_options.add_argument("--disable-background-networking")
-            chrome_options.add_argument("--disable-default-apps")
-            chrome_options.add_argument("--disable-sync")
-            chrome_options.add_argument("--disable-translate")
-            chrome_options.add_argument("--hide-scrollbars")
-            chrome_options.add_argument("--metrics-recording-only")
-            chrome_options.add_argument("--mute-audio")
-            chrome_options.add_argument("--no-first-run")
-            chrome_options.add_argument("--safebrowsing-disable-auto-update")
-            chrome_options.add_argument("--ignore-certificate-errors")
-            chrome_options.add_argument("--ignore-ssl-errors")
-            chrome_options.add_argument("--ignore-certificate-errors-spki-list")
-            chrome_options.add_argument("--disable-features=VizDisplayCompositor")
-            chrome_options.add_argument("--disable-web-security")
-            chrome_options.add_argument("--disable-blink-features=AutomationControlled")
-            chrome_options.add_argument("--disable-infobars")
-            chrome_options.add_argument("--disable-notifications")
-            chrome_options.add_argument("--disable-popup-blocking")
-            chrome_options.add_argument("--disable-session-crashed-bubble")
-            chrome_options.add_argument("--disable-password-generation")
-            chrome_options.add_argument("--disable-password-manager-reauthentication")
-            chrome_options.add_argument("--single-process")
-            chrome_options.add_argument("--no-zygote")
-            chrome_options.add_argument("--user-agent=Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
-            chrome_options.add_argument(f"--user-data-dir={user_data_dir}")
-            chrome_options.add_argument(f"--profile-directory=Default")
-            chrome_options.add_argument(f"--remote-debugging-port={9222 + hash(self.device_id) % 1000}")
-            chrome_options.add_argument("--window-size=1920,1080")
-            chrome_options.add_argument("--start-maximized")
-            
             if self.headless:
-                chrome_options.add_argument("--headless=new")
-                chrome_options.add_argument("--disable-gpu")
                 logger.info(f"Running in headless mode for device: {self.device_id}")
-            
-            prefs = {
-                "profile.default_content_setting_values.notifications": 2,
-                "profile.default_content_settings.popups": 0,
-                "profile.managed_default_content_settings.images": 2,
-                "profile.content_settings.exceptions.automatic_downloads.*.setting": 1,
-                "profile.default_content_setting_values.media_stream_mic": 2,
-                "profile.default_content_setting_values.media_stream_camera": 2,
-                "profile.default_content_setting_values.geolocation": 2,
-                "profile.default_content_setting_values.desktop_notification": 2
-            }
-            chrome_options.add_experimental_option("prefs", prefs)
-            chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
-            chrome_options.add_experimental_option('useAutomationExtension', False)
-            
-            service = Service(chromedriver_path)
-            self.driver = webdriver.Chrome(service=service, options=chrome_options)
-            self.driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-            self.driver.set_page_load_timeout(30)
-            self.driver.implicitly_wait(5)
+            driver = create_driver(
+                self.user_data_dir,
+                headless=self.headless,
+                debug_port=9222 + hash(self.device_id) % 1000
+            )
+            self.bind(driver)
             
             logger.info(f"Chrome WebDriver initialized successfully for device: {self.device_id}")
             return True
@@ -174,26 +259,68 @@ class WhatsAppBot:
             logger.error(f"Failed to setup WebDriver for device {self.device_id}: {str(e)}")
             return False
     
-    def initialize_session(self):
+    def bind(self, driver, pool=None):
+        """Attach an already running WebDriver, optionally borrowed from a DriverPool"""
+        if self._finalizer:
+            self._finalizer.detach()
+        self.driver = driver
+        self._pool = pool
+        self._waits = {}
+        # Runs if the bot is garbage collected or the interpreter exits without close()
+        self._finalizer = weakref.finalize(self, _safe_close, driver, self.device_id, pool)
+        logger.info(f"WebDriver bound to device: {self.device_id}")
+    
+    def _navigate(self, url):
+        """driver.get that relaunches Chrome once if the current browser or chromedriver has died"""
         try:
+            self.driver.get(url)
+        except TimeoutException:
+            raise
+        except WebDriverException as e:
+            logger.warning(f"WebDriver for device {self.device_id} is unusable ({e.msg}), relaunching Chrome")
+            self._drop_driver()
             if not self._setup_driver():
+                raise
+            self.driver.get(url)
+    
+    def _wait(self, timeout):
+        """WebDriverWait for the current driver, built once per timeout value"""
+        wait = self._waits.get(timeout)
+        if wait is None:
+            wait = self._waits[timeout] = WebDriverWait(self.driver, timeout)
+        return wait
+    
+    @timed("initialize_session")
+    def initialize_session(self):
+        try:
+            if not self.driver and not self._setup_driver():
                 return {'success': False, 'error': 'Failed to setup WebDriver'}
             
             logger.info(f"Loading WhatsApp Web for device: {self.device_id}")
-            self.driver.get(self.whatsapp_url)
-            time.sleep(3)
+            self._navigate(self.whatsapp_url)
+            try:
+                self._wait(30).until(any_element_present(self.LANDING_SELECTOR))
+            except TimeoutException:
+                logger.warning(f"WhatsApp Web slow to load for device: {self.device_id}")
             
             if self._check_authentication():
                 logger.info(f"Device {self.device_id} already authenticated")
+                self._save_session_meta()
                 return {'success': True, 'qr_required': False}
             
             qr_code_present = self._wait_for_qr_code()
             if qr_code_present:
                 logger.info(f"QR code detected for device: {self.device_id}")
+                self._clear_session_meta()
                 self._save_qr_code()
                 auth_success = self._wait_for_authentication(timeout=300)
+                if self.closing.is_set():
+                    logger.info(f"Stopped waiting for QR scan, session for device {self.device_id} is closing")
+                    return {'success': False, 'error': 'Session was closed while waiting for the QR scan'}
                 if auth_success:
                     logger.info(f"Authentication successful for device: {self.device_id}")
+                    self.qr_png_bytes = None
+                    self._save_session_meta()
                     return {'success': True, 'qr_required': True}
                 else:
                     logger.warning(f"Authentication timeout for device: {self.device_id}")
@@ -201,20 +328,46 @@ class WhatsAppBot:
             else:
                 if self._check_authentication():
                     logger.info(f"Device {self.device_id} authenticated without QR scan")
+                    self._save_session_meta()
                     return {'success': True, 'qr_required': False}
                 return {'success': False, 'error': 'Unable to load WhatsApp Web'}
         except Exception as e:
             logger.error(f"Error initializing session for device {self.device_id}: {str(e)}")
             return {'success': False, 'error': str(e)}
     
+    def _load_session_meta(self):
+        return load_session_meta(self.meta_path)
+    
+    def recently_authenticated(self, max_age_seconds):
+        """True if the saved metadata records a login within the last max_age_seconds"""
+        authed_at = self._load_session_meta().get('authed_at')
+        if not isinstance(authed_at, (int, float)):
+            return False
+        return time.time() - authed_at < max_age_seconds
+    
+    def _write_session_meta(self, meta):
+        try:
+            with open(self.meta_path, 'w') as f:
+                json.dump(meta, f)
+        except OSError as e:
+            logger.error(f"Error saving session metadata for device {self.device_id}: {str(e)}")
+    
+    def _save_session_meta(self):
+        """Record the login on disk so a restarted process can trust the profile without loading WhatsApp Web"""
+        if self._pool:
+            # Logged in on a pre-warmed driver: its profile becomes this device's profile
+            self.user_data_dir = self._pool.adopt(self.driver)
+            self.bind(self.driver)
+        self._write_session_meta({'authed_at': time.time(), 'user_data_dir': self.user_data_dir})
+    
+    def _clear_session_meta(self):
+        if self._pool:
+            return  # Still on a borrowed profile, nothing of ours on disk yet
+        self._write_session_meta({'user_data_dir': self.user_data_dir})
+    
     def _wait_for_qr_code(self, timeout=30):
         try:
-            qr_selectors = [
-                'canvas[aria-label="Scan me!"]',
-                'div[data-ref] canvas',
-                'canvas[aria-label*="QR"]'
-            ]
-            WebDriverWait(self.driver, timeout).until(any_element_present(*qr_selectors))
+            self._wait(timeout).until(any_element_present(self.QR_SELECTOR))
             logger.info(f"QR code found")
             return True
         except TimeoutException:
@@ -222,38 +375,31 @@ class WhatsAppBot:
     
     def _save_qr_code(self):
         try:
-            qr_selectors = [
-                'canvas[aria-label="Scan me!"]',
-                'div[data-ref] canvas',
-                'canvas[aria-label*="QR"]'
-            ]
-            for selector in qr_selectors:
-                try:
-                    qr_element = self.driver.find_element(By.CSS_SELECTOR, selector)
-                    canvas_base64 = self.driver.execute_script(
-                        "return arguments[0].toDataURL('image/png').substring(21);",
-                        qr_element
-                    )
-                    with open(self.qr_code_path, 'wb') as f:
-                        f.write(base64.b64decode(canvas_base64))
-                    logger.info(f"QR code saved for device: {self.device_id}")
-                    return True
-                except NoSuchElementException:
-                    continue
-            logger.warning(f"Could not save QR code for device: {self.device_id}")
-            return False
+            qr_element = first_present(*self.QR_SELECTORS)(self.driver)
+            if not qr_element:
+                logger.warning(f"Could not save QR code for device: {self.device_id}")
+                return False
+            canvas_base64 = self.driver.execute_script(
+                "return arguments[0].toDataURL('image/png').substring(21);",
+                qr_element
+            )
+            self.qr_png_bytes = base64.b64decode(canvas_base64)
+            logger.info(f"QR code captured for device: {self.device_id}")
+            return True
         except Exception as e:
             logger.error(f"Error in _save_qr_code: {str(e)}")
             return False
     
     def _wait_for_authentication(self, timeout=300):
+        authenticated = any_element_present(self.AUTHENTICATED_SELECTOR)
         try:
-            end_time = time.time() + timeout
-            while time.time() < end_time:
-                if self._check_authentication():
-                    self.is_authenticated = True
-                    return True
-                time.sleep(2)
+            # Also stop polling once close is requested, so the closer isn't stuck behind a QR wait
+            self._wait(timeout).until(lambda driver: self.closing.is_set() or authenticated(driver))
+            if self.closing.is_set():
+                return False
+            self.is_authenticated = True
+            return True
+        except TimeoutException:
             return False
         except Exception as e:
             logger.error(f"Error waiting for authentication: {str(e)}")
@@ -261,40 +407,55 @@ class WhatsAppBot:
     
     def _check_authentication(self):
         try:
-            authenticated_selectors = [
-                'div[data-testid="chat-list"]',
-                'div[aria-label="Chat list"]',
-                'div[data-testid="side"]',
-                'header[data-testid="chatlist-header"]'
-            ]
-            WebDriverWait(self.driver, 5).until(any_element_present(*authenticated_selectors))
+            self._wait(5).until(any_element_present(self.AUTHENTICATED_SELECTOR))
             self.is_authenticated = True
             return True
         except TimeoutException:
             return False
     
-    def send_message(self, phone_number, message=None, media_path=None):
-        try:
-            if not self.driver:
-                init_result = self.initialize_session()
-                if not init_result['success']:
-                    return init_result
-            
-            if not self.is_authenticated and not self._check_authentication():
+    def _open_chat(self, phone_number):
+        """Make sure the session is ready and open the chat; returns an error result or None"""
+        if not self.driver:
+            if self.is_authenticated:
+                # Login restored from session metadata; the chat URL loads WhatsApp Web by itself
+                if not self._setup_driver():
+                    return {'success': False, 'error': 'Failed to setup WebDriver'}
+            else:
                 init_result = self.initialize_session()
                 if not init_result['success']:
                     return init_result
-            
-            clean_phone = ''.join(filter(str.isdigit, phone_number))
-            if not clean_phone.startswith('91') and len(clean_phone) == 10:
-                clean_phone = '91' + clean_phone
-            
-            chat_url = f"https://web.whatsapp.com/send?phone={clean_phone}"
-            logger.info(f"Navigating to chat for number: {phone_number[:5]}*****")
-            self.driver.get(chat_url)
-            
-            if not self._wait_for_chat_to_load():
-                return {'success': False, 'error': 'Failed to load chat interface'}
+        
+        if not self.is_authenticated and not self._check_authentication():
+            init_result = self.initialize_session()
+            if not init_result['success']:
+                return init_result
+        
+        clean_phone = phone_number.translate(_NONDIGIT)
+        if not clean_phone.isdigit():
+            # Something outside Latin-1 survived the table; fall back to the per-character filter
+            clean_phone = ''.join(filter(str.isdigit, clean_phone))
+        if not clean_phone.startswith('91') and len(clean_phone) == 10:
+            clean_phone = '91' + clean_phone
+        
+        chat_url = f"https://web.whatsapp.com/send?phone={clean_phone}"
+        logger.info(f"Navigating to chat for number: {phone_number[:5]}*****")
+        self._navigate(chat_url)
+        
+        if not self._wait_for_chat_to_load():
+            if not self._check_authentication():
+                logger.warning(f"Device {self.device_id} is no longer authenticated")
+                self.is_authenticated = False
+                self._clear_session_meta()
+                return {'success': False, 'error': 'Session is no longer authenticated'}
+            return {'success': False, 'error': 'Failed to load chat interface'}
+        return None
+    
+    @timed("send_message")
+    def send_message(self, phone_number, message=None, media_path=None):
+        try:
+            error = self._open_chat(phone_number)
+            if error:
+                return error
             
             if media_path and os.path.exists(media_path):
                 if not self._send_media(media_path):
@@ -310,119 +471,119 @@ class WhatsAppBot:
             logger.error(f"Error sending message to {phone_number[:5]}*****: {str(e)}")
             return {'success': False, 'error': str(e)}
     
+    @timed("send_messages")
+    def send_messages(self, phone_number, messages):
+        """Send several text messages to one number, opening the chat only once.
+
+        Returns one result dict per message, in order.
+        """
+        try:
+            error = self._open_chat(phone_number)
+        except Exception as e:
+            logger.error(f"Error opening chat for {phone_number[:5]}*****: {str(e)}")
+            error = {'success': False, 'error': str(e)}
+        if error:
+            return [dict(error) for _ in messages]
+        
+        results = []
+        for message in messages:
+            if self._send_text_message(message):
+                results.append({'success': True})
+            else:
+                results.append({'success': False, 'error': 'Failed to send text message'})
+        sent = sum(1 for result in results if result['success'])
+        logger.info(f"Sent {sent}/{len(messages)} messages to {phone_number[:5]}*****")
+        return results
+    
+    @timed("_wait_for_chat_to_load")
     def _wait_for_chat_to_load(self, timeout=30):
         try:
-            chat_selectors = [
-                'div[data-testid="conversation-compose-box-input"]',
-                'div[contenteditable="true"][data-tab="10"]',
-                'div[role="textbox"]'
-            ]
-            WebDriverWait(self.driver, timeout).until(any_element_present(*chat_selectors))
-            time.sleep(1)
+            self._wait(timeout).until(any_element_present(self.CHAT_INPUT_SELECTOR))
             return True
         except TimeoutException:
             return False
     
+    @timed("_send_text_message")
     def _send_text_message(self, message):
+        if not message.strip():
+            # Nothing to insert, and WhatsApp won't send a blank message anyway
+            logger.error("Message has no visible text to send")
+            return False
         try:
-            input_selectors = [
-                'div[data-testid="conversation-compose-box-input"]',
-                'div[contenteditable="true"][data-tab="10"]',
-                'div[role="textbox"]'
-            ]
-            message_box = None
-            for selector in input_selectors:
-                try:
-                    message_box = WebDriverWait(self.driver, 10).until(
-                        EC.element_to_be_clickable((By.CSS_SELECTOR, selector))
-                    )
-                    break
-                except TimeoutException:
-                    continue
-            
-            if not message_box:
+            try:
+                message_box = self._wait(10).until(
+                    first_clickable(*self.CHAT_INPUT_SELECTORS)
+                )
+            except TimeoutException:
                 logger.error("Could not find message input box")
                 return False
             
             message_box.click()
-            time.sleep(0.5)
-            lines = message.split('\n')
-            for i, line in enumerate(lines):
-                message_box.send_keys(line)
-                if i < len(lines) - 1:
-                    message_box.send_keys(Keys.SHIFT + Keys.ENTER)
-            time.sleep(0.5)
-            message_box.send_keys(Keys.ENTER)
-            time.sleep(1)
+            # Insert text straight through CDP: one command per line instead of per keystroke.
+            # Shift+Enter makes a line break without sending.
+            for i, line in enumerate(message.split('\n')):
+                if i:
+                    self._press_enter(shift=True)
+                if line:
+                    self.driver.execute_cdp_cmd("Input.insertText", {"text": line})
+            self._wait(5).until(lambda _: message_box.text)
+            self._press_enter()
+            # WhatsApp empties the compose box once it has taken the message
+            self._wait(10).until(compose_box_cleared(message_box))
             return True
         except Exception as e:
             logger.error(f"Error sending text message: {str(e)}")
             return False
     
+    def _press_enter(self, shift=False):
+        """Press Enter in the focused element via CDP key events"""
+        key = {
+            "key": "Enter",
+            "code": "Enter",
+            "windowsVirtualKeyCode": 13,
+            "nativeVirtualKeyCode": 13,
+            "modifiers": 8 if shift else 0,  # 8 = Shift
+        }
+        self.driver.execute_cdp_cmd("Input.dispatchKeyEvent", {"type": "keyDown", "text": "\r", **key})
+        self.driver.execute_cdp_cmd("Input.dispatchKeyEvent", {"type": "keyUp", **key})
+    
     def _send_media(self, media_path):
         try:
-            attachment_selectors = [
-                'div[data-testid="clip"]',
-                'span[data-testid="clip"]',
-                'div[title="Attach"]'
-            ]
-            attachment_btn = None
-            for selector in attachment_selectors:
-                try:
-                    attachment_btn = WebDriverWait(self.driver, 10).until(
-                        EC.element_to_be_clickable((By.CSS_SELECTOR, selector))
-                    )
-                    break
-                except TimeoutException:
-                    continue
-            
-            if not attachment_btn:
+            try:
+                attachment_btn = self._wait(10).until(
+                    first_clickable(*self.ATTACH_SELECTORS)
+                )
+            except TimeoutException:
                 logger.error("Could not find attachment button")
                 return False
             
             attachment_btn.click()
-            time.sleep(1)
-            file_input_selectors = [
-                'input[accept*="image"]',
-                'input[type="file"]'
-            ]
-            file_input = None
-            for selector in file_input_selectors:
-                try:
-                    file_input = self.driver.find_element(By.CSS_SELECTOR, selector)
-                    break
-                except NoSuchElementException:
-                    continue
-            
-            if not file_input:
+            try:
+                file_input = self._wait(10).until(
+                    first_present(*self.FILE_INPUT_SELECTORS)
+                )
+            except TimeoutException:
                 logger.error("Could not find file input")
                 return False
             
             absolute_path = os.path.abspath(media_path)
             file_input.send_keys(absolute_path)
-            time.sleep(2)
-            send_selectors = [
-                'span[data-testid="send"]',
-                'div[data-testid="send"]',
-                'button[data-testid="send"]'
-            ]
-            send_btn = None
-            for selector in send_selectors:
-                try:
-                    send_btn = WebDriverWait(self.driver, 10).until(
-                        EC.element_to_be_clickable((By.CSS_SELECTOR, selector))
-                    )
-                    break
-                except TimeoutException:
-                    continue
-            
-            if send_btn:
-                send_btn.click()
-                time.sleep(2)
-                return True
-            else:
+            try:
+                send_btn = self._wait(10).until(
+                    first_clickable(*self.SEND_SELECTORS)
+                )
+            except TimeoutException:
                 logger.error("Could not find send button for media")
                 return False
+            
+            send_btn.click()
+            try:
+                # The preview (and its send button) goes away once the upload is handed off
+                self._wait(10).until(EC.staleness_of(send_btn))
+            except TimeoutException:
+                logger.error("Media preview did not close after sending")
+                return False
+            return True
         except Exception as e:
             logger.error(f"Error sending media: {str(e)}")
             return False
@@ -441,39 +602,99 @@ class WhatsAppBot:
             logger.error(f"Error getting session status: {str(e)}")
             return 'error'
     
-    def get_qr_code_path(self):
-        return self.qr_code_path if os.path.exists(self.qr_code_path) else None
+    def _drop_driver(self):
+        """Quit (or hand back to the pool) the current driver and forget it, even if it is already dead"""
+        if self._finalizer:
+            self._finalizer.detach()
+            self._finalizer = None
+        driver, pool = self.driver, self._pool
+        self.driver = None
+        self._pool = None
+        self._waits = {}
+        if driver:
+            try:
+                if pool:
+                    pool.release(driver)
+                else:
+                    driver.quit()
+            except Exception as e:
+                logger.error(f"Error quitting WebDriver for device {self.device_id}: {str(e)}")
     
     def close(self):
         try:
             if self.driver:
                 logger.info(f"Closing WhatsApp bot session for device: {self.device_id}")
-                self.driver.quit()
-                self.driver = None
-                self.is_authenticated = False
-                if os.path.exists(self.qr_code_path):
-                    os.remove(self.qr_code_path)
+            self._drop_driver()
+            self.is_authenticated = False
+            self.qr_png_bytes = None
         except Exception as e:
             logger.error(f"Error closing session for device {self.device_id}: {str(e)}")
-    
-    def __del__(self):
+
+def load_session_meta(meta_path):
+    """Read a device's meta.json; {} if it is missing or corrupt, minus a user_data_dir that no longer exists"""
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(meta, dict):
+        return {}
+    user_data_dir = meta.get('user_data_dir')
+    if not isinstance(user_data_dir, str) or not os.path.isdir(user_data_dir):
+        meta.pop('user_data_dir', None)
+    return meta
+
+def _safe_close(driver, device_id, pool=None):
+    """Release a driver left behind by an unclosed bot without stalling GC or shutdown on chromedriver"""
+    def release():
         try:
-            if hasattr(self, 'device_id'):
-                logger.info(f"Cleaning up WhatsApp bot for device: {self.device_id}")
-            self.close()
-        except Exception as e:
-            if hasattr(self, 'device_id'):
-                logger.error(f"Error in __del__ for device {self.device_id}: {str(e)}")
+            if pool:
+                pool.release(driver)
             else:
-                logger.error(f"Error in __del__: {str(e)}")
+                driver.quit()
+        except Exception as e:
+            logger.error(f"Error releasing WebDriver for device {device_id}: {str(e)}")
+    
+    worker = threading.Thread(target=release, name=f"release-{device_id}", daemon=True)
+    worker.start()
+    worker.join(FINALIZER_TIMEOUT)
+    if worker.is_alive():
+        logger.warning(f"Gave up waiting for WebDriver of device {device_id} to shut down")
+
+def compose_box_cleared(message_box):
+    """Wait condition for the compose box to be empty, or replaced after the message went out"""
+    def condition(driver):
+        try:
+            return not message_box.text
+        except StaleElementReferenceException:
+            return True
+    return condition
 
-def any_element_present(*selectors):
+def first_present(*selectors):
+    """Wait condition returning the first match of the highest-priority selector that matches"""
     def condition(driver):
         for selector in selectors:
+            elements = driver.find_elements(By.CSS_SELECTOR, selector)
+            if elements:
+                return elements[0]
+        return False
+    return condition
+
+def first_clickable(*selectors):
+    """Like first_present, but only accepts an element that is visible and enabled"""
+    def condition(driver):
+        for selector in selectors:
+            elements = driver.find_elements(By.CSS_SELECTOR, selector)
             try:
-                if driver.find_element(By.CSS_SELECTOR, selector):
-                    return True
-            except NoSuchElementException:
-                pass
+                if elements and elements[0].is_displayed() and elements[0].is_enabled():
+                    return elements[0]
+            except StaleElementReferenceException:
+                continue
         return False
+    return condition
+
+def any_element_present(selector):
+    """Wait condition for a (possibly comma-separated) CSS selector, one find_elements per poll"""
+    def condition(driver):
+        return bool(driver.find_elements(By.CSS_SELECTOR, selector))
     return condition
\ No newline at end of file